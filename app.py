@@ -1,88 +1,225 @@
 import streamlit as st
 import sqlite3
 import pandas as pd
-import openai
 import os
+from openai import OpenAI
+from sql_utils import (
+    SYSTEM_PROMPT,
+    SYSTEM_PROMPT_HASH,
+    ResponseCache,
+    completion_budget,
+    configure_sqlite,
+    extract_sql_from_response,
+    is_read_query,
+    read_sql_chunked,
+)
 
-openai.api_key =  os.getenv("OPENAI_API_KEY")
 DB_PATH = "patient.db"
+# Covers the Top Labs GROUP BY so it can be answered from the index alone.
+# Database.ipynb builds it into patient.db; this only fills in older copies.
+SQLITE_INDEXES = (
+    "CREATE INDEX IF NOT EXISTS idx_stage_labs_patient ON stage_labs(PatientID, LabName);",
+)
 
 
-def query_db(sql_query):
-    conn = sqlite3.connect(DB_PATH)
+@st.cache_resource
+def get_conn():
+    conn = sqlite3.connect(DB_PATH, check_same_thread=False)
+    configure_sqlite(conn, SQLITE_INDEXES)
+    # Every query on the shared connection is a read, including AI and custom SQL
+    conn.execute("PRAGMA query_only=ON;")
+    return conn
+
+
+def fast_preview(sql: str, params: tuple = ()) -> pd.DataFrame:
+    # Plain DB-API fetch; pandas' SQL dispatch is overkill for a handful of rows
+    cur = get_conn().execute(sql, params)
+    rows = cur.fetchall()
+    cols = [d[0] for d in cur.description]
+    return pd.DataFrame.from_records(rows, columns=cols)
+
+
+@st.cache_data(ttl=600, show_spinner=False)
+def cached_query(sql: str, params: tuple = ()) -> pd.DataFrame:
+    return fast_preview(sql, params)
+
+
+def query_db(sql_query, params=(), cached=False):
     try:
-        df = pd.read_sql_query(sql_query, conn)
+        if cached:
+            return cached_query(sql_query, params)
+        df, truncated = read_sql_chunked(sql_query, get_conn(), params)
+        if truncated:
+            st.warning(f"Result truncated to the first {len(df)} rows.")
         return df
-    except Exception as e:
+    except (sqlite3.Error, pd.errors.DatabaseError, TypeError) as e:
+        # Statements without a result set (UPDATE, CREATE, ...) surface as TypeError.
+        # Roll back so the shared connection never keeps a transaction open.
+        get_conn().rollback()
         st.error(f"SQL error: {e}")
         return pd.DataFrame()
-    finally:
-        conn.close()
 
-def ask_openai(prompt):
-    response = openai.ChatCompletion.create(
-        model="gpt-4",
-        messages=[
-            {"role": "system", "content": "You are a helpful assistant that generates SQL queries for a SQLite database."},
-            {"role": "user", "content": prompt}
-        ],
-        temperature=0
-    )
-    return response.choices[0].message["content"]
+PREVIEW_COLUMNS = 12
 
 
-st.title("Patient Database Explorer with OpenAI")
+def quote_ident(name):
+    return '"' + name.replace('"', '""') + '"'
 
 
-conn = sqlite3.connect(DB_PATH)
-tables = pd.read_sql_query("SELECT name FROM sqlite_master WHERE type='table';", conn)
-conn.close()
-st.sidebar.subheader("Tables in database")
-st.sidebar.table(tables)
+@st.cache_data(ttl=600, show_spinner=False)
+def load_preview(table: str, limit: int = 10) -> pd.DataFrame:
+    # Column lookup and row fetch share one cache entry per table
+    columns = fast_preview(f"PRAGMA table_info({quote_ident(table)});")
+    if columns.empty:
+        return pd.DataFrame()
+    # Project only the first few columns so wide tables stay cheap to render
+    col_list = ", ".join(quote_ident(c) for c in columns["name"].tolist()[:PREVIEW_COLUMNS])
+    # Identifiers can't be bound as parameters, so the SQL text is fixed per table
+    sql = f"SELECT {col_list} FROM {quote_ident(table)} LIMIT ?;"
+    if not sqlite3.complete_statement(sql):
+        return pd.DataFrame()
+    return fast_preview(sql, (limit,))
 
-table_selected = st.sidebar.selectbox("Select a table to view", tables["name"].tolist())
-if table_selected:
-    st.subheader(f"Preview of {table_selected}")
-    df = query_db(f"SELECT * FROM {table_selected} LIMIT 10;")
-    st.dataframe(df)
 
+def preview_table(table, limit=10):
+    try:
+        return load_preview(table, limit)
+    except (sqlite3.Error, pd.errors.DatabaseError) as e:
+        st.error(f"SQL error: {e}")
+        return pd.DataFrame()
 
-st.subheader("First 10 Patients")
-df_patients = query_db("SELECT * FROM patients LIMIT 10;")
-st.dataframe(df_patients)
 
-st.subheader("Top Patients by Lab Count")
-df_lab_counts = query_db("""
+TOP_LABS_SQL = """
 SELECT PatientID, COUNT(LabName) AS LabCount
 FROM stage_labs
 GROUP BY PatientID
 ORDER BY LabCount DESC
 LIMIT 10;
-""")
-st.dataframe(df_lab_counts)
-st.bar_chart(df_lab_counts.set_index("PatientID"))
+"""
+
+
+@st.cache_data(ttl=3600, max_entries=1, show_spinner=False)
+def load_top_lab_counts() -> pd.DataFrame:
+    df = pd.read_sql_query(TOP_LABS_SQL, get_conn())
+    # Explicit dtypes spare Streamlit's Arrow serializer from inferring object columns
+    return df.astype({"PatientID": "string", "LabCount": "int32"})
+
+
+def top_lab_counts():
+    try:
+        return load_top_lab_counts()
+    except (sqlite3.Error, pd.errors.DatabaseError) as e:
+        st.error(f"SQL error: {e}")
+        return pd.DataFrame()
+
+
+@st.cache_resource
+def get_openai_client():
+    return OpenAI(api_key=os.getenv("OPENAI_API_KEY"))
+
+
+AI_MODEL = "gpt-4"
+
+
+@st.cache_resource
+def get_ai_cache():
+    # Shared across sessions; st.cache_data can't wrap a streamed response
+    return ResponseCache(max_entries=512, ttl=86400)
+
+
+def ask_openai(prompt):
+    cache = get_ai_cache()
+    key = (prompt, AI_MODEL, SYSTEM_PROMPT_HASH)
+    cached = cache.get(key)
+    if cached is not None:
+        return cached
+
+    stream = get_openai_client().chat.completions.create(
+        model=AI_MODEL,
+        messages=[
+            {"role": "system", "content": SYSTEM_PROMPT},
+            {"role": "user", "content": prompt}
+        ],
+        temperature=0,
+        max_tokens=completion_budget(prompt, AI_MODEL),
+        stream=True
+    )
+    # Render tokens as they arrive instead of waiting for the full completion
+    full = st.write_stream(
+        chunk.choices[0].delta.content or "" for chunk in stream if chunk.choices
+    )
+    cache.set(key, full)
+    return full
 
 
-st.subheader("Run a Custom SQL Query")
-user_query = st.text_area("Enter SQL query here", height=100)
-if st.button("Run Query"):
-    if user_query.strip() != "":
-        df_custom = query_db(user_query)
-        st.dataframe(df_custom)
+def show_dataframe(df):
+    # Skip serializing an empty table to the front-end
+    if df.empty:
+        st.info("No rows returned.")
+    else:
+        st.dataframe(df)
 
 
-st.subheader("Ask a Question (OpenAI)")
-user_prompt = st.text_area("Enter your question about the patient data", height=100)
+st.title("Patient Database Explorer with OpenAI")
 
-if st.button("Ask AI"):
-    if user_prompt.strip() != "":
-        with st.spinner("Generating SQL query with OpenAI..."):
-            ai_sql = ask_openai(f"Generate a valid SQLite query for this database: {user_prompt}")
-            st.code(ai_sql, language="sql")
-            
-            # Try running the SQL query
-            st.subheader("AI Query Results")
-            df_ai = query_db(ai_sql)
-            st.dataframe(df_ai)
 
+tables = query_db("SELECT name FROM sqlite_master WHERE type='table';", cached=True)
+st.sidebar.subheader("Tables in database")
+st.sidebar.table(tables)
 
+table_names = tables["name"].tolist() if not tables.empty else []
+table_selected = st.sidebar.selectbox("Select a table to view", table_names)
+if table_selected in table_names:
+    st.subheader(f"Preview of {table_selected}")
+    df = preview_table(table_selected)
+    show_dataframe(df)
+
+
+st.subheader("First 10 Patients")
+df_patients = query_db("SELECT * FROM patients LIMIT 10;", cached=True)
+show_dataframe(df_patients)
+
+st.subheader("Top Patients by Lab Count")
+df_lab_counts = top_lab_counts()
+show_dataframe(df_lab_counts)
+if not df_lab_counts.empty:
+    st.bar_chart(df_lab_counts, x="PatientID", y="LabCount")
+
+
+# Fragments rerun on their own widget interactions, leaving the panels above untouched
+@st.fragment
+def custom_query_panel():
+    st.subheader("Run a Custom SQL Query")
+    user_query = st.text_area("Enter SQL query here", height=100)
+    if st.button("Run Query"):
+        if user_query.strip() != "":
+            if not is_read_query(user_query):
+                st.error("Only read queries (SELECT, WITH, PRAGMA) are allowed.")
+                return
+            df_custom = query_db(user_query)
+            show_dataframe(df_custom)
+
+
+@st.fragment
+def ai_panel():
+    st.subheader("Ask a Question (OpenAI)")
+    user_prompt = st.text_area("Enter your question about the patient data", height=100)
+
+    if st.button("Ask AI"):
+        if user_prompt.strip() != "":
+            with st.spinner("Generating SQL query with OpenAI..."):
+                ai_response = ask_openai(f"Generate a valid SQLite query for this database: {user_prompt}")
+                ai_sql = extract_sql_from_response(ai_response)
+                st.code(ai_sql, language="sql")
+
+                # Try running the SQL query
+                st.subheader("AI Query Results")
+                if not is_read_query(ai_sql):
+                    st.error("Only read queries (SELECT, WITH, PRAGMA) are allowed.")
+                    return
+                df_ai = query_db(ai_sql)
+                show_dataframe(df_ai)
+
+
+custom_query_panel()
+ai_panel()
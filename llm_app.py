@@ -1,7 +1,8 @@
 import os
-import re
+import json
+import asyncio
+from collections import deque
 import streamlit as st
-import pandas as pd
 
 # Load environment variables from .env (only if exists)
 from dotenv import load_dotenv
@@ -10,7 +11,17 @@ if os.path.exists(dotenv_path):
     load_dotenv(dotenv_path)
 
 # ---------- OpenAI API Key ----------
-from openai import OpenAI
+from openai import AsyncOpenAI, OpenAI
+from sql_utils import (
+    SYSTEM_PROMPT,
+    SYSTEM_PROMPT_HASH,
+    ResponseCache,
+    completion_budget,
+    configure_sqlite,
+    extract_sql_from_response,
+    is_read_query,
+    read_sql_chunked,
+)
 OPENAI_API_KEY = os.getenv("OPENAI_API_KEY")
 
 # ---------- Decide which database to use ----------
@@ -49,63 +60,19 @@ try:
 except Exception as e:
     st.error(f"Error listing tables: {e}")
 
-# ---------- Database schema ----------
-DATABASE_SCHEMA = """
-Database Schema:
-
-LOOKUP TABLES:
-- genders (gender_id INTEGER PRIMARY KEY, gender_desc TEXT)
-- races (race_id INTEGER PRIMARY KEY, race_desc TEXT)
-- marital_statuses (marital_status_id INTEGER PRIMARY KEY, marital_status_desc TEXT)
-- languages (language_id INTEGER PRIMARY KEY, language_desc TEXT)
-- lab_units (unit_id INTEGER PRIMARY KEY, unit_string TEXT)
-- lab_tests (lab_test_id INTEGER PRIMARY KEY, lab_name TEXT, unit_id INTEGER)
-- diagnosis_codes (diagnosis_code TEXT PRIMARY KEY, diagnosis_description TEXT)
-
-CORE TABLES:
-- patients (
-    patient_id TEXT PRIMARY KEY,
-    patient_gender INTEGER REFERENCES genders(gender_id),
-    patient_dob TIMESTAMP,
-    patient_race INTEGER REFERENCES races(race_id),
-    patient_marital_status INTEGER REFERENCES marital_statuses(marital_status_id),
-    patient_language INTEGER REFERENCES languages(language_id),
-    patient_population_pct_below_poverty REAL
-)
-
-- admissions (
-    patient_id TEXT,
-    admission_id INTEGER,
-    admission_start TIMESTAMP,
-    admission_end TIMESTAMP,
-    PRIMARY KEY (patient_id, admission_id)
-)
-
-- admission_primary_diagnoses (
-    patient_id TEXT,
-    admission_id INTEGER,
-    diagnosis_code TEXT REFERENCES diagnosis_codes(diagnosis_code),
-    PRIMARY KEY (patient_id, admission_id)
-)
-
-- admission_lab_results (
-    patient_id TEXT,
-    admission_id INTEGER,
-    lab_value REAL,
-    lab_datetime TIMESTAMP,
-    lab_test_id INTEGER REFERENCES lab_tests(lab_test_id)
-)
-"""
-
 # ---------- Database connection helper ----------
 @st.cache_resource
 def get_db_connection():
     """Return a database connection."""
     try:
+        # Queries come from the model, so the connection itself refuses writes
         if DATABASE_URL:
             conn = psycopg2.connect(DATABASE_URL)
+            conn.set_session(readonly=True, autocommit=True)
         else:
             conn = sqlite3.connect(DB_PATH, check_same_thread=False)
+            configure_sqlite(conn)
+            conn.execute("PRAGMA query_only=ON;")
         return conn
     except Exception as e:
         st.error(f"Failed to connect to database: {e}")
@@ -113,11 +80,17 @@ def get_db_connection():
 
 # ---------- Run SQL query ----------
 def run_query(sql):
+    if not is_read_query(sql):
+        st.error("Only read queries (SELECT, WITH, PRAGMA) are allowed.")
+        return None
     conn = get_db_connection()
     if conn is None:
         return None
     try:
-        df = pd.read_sql_query(sql, conn)
+        # Read in chunks so unbounded AI queries stop at MAX_ROWS
+        df, truncated = read_sql_chunked(sql, conn)
+        if truncated:
+            st.warning(f"Result truncated to the first {len(df)} rows.")
         return df
     except Exception as e:
         st.error(f"Error executing query: {e}")
@@ -128,55 +101,180 @@ def run_query(sql):
 def get_openai_client():
     return OpenAI(api_key=OPENAI_API_KEY)
 
-# ---------- Extract SQL from GPT response ----------
-def extract_sql_from_response(response_text):
-    sql_pattern = r"```sql\s*(.*?)\s*```"
-    matches = re.findall(sql_pattern, response_text, re.DOTALL | re.IGNORECASE)
-    if matches:
-        return matches[0].strip()
-    code_pattern = r"```(?:.*)?\s*(.*?)\s*```"
-    matches = re.findall(code_pattern, response_text, re.DOTALL)
-    if matches:
-        return matches[0].strip()
-    return response_text.strip()
-
 # ---------- Generate SQL using GPT ----------
-def generate_sql_with_gpt(question):
-    client = get_openai_client()
-    prompt = f"""
-You are an SQLite expert. Given the following database schema and a user's question, generate a valid SQLite query.
+SQL_MODEL = "gpt-4o-mini"
 
-{DATABASE_SCHEMA}
-
-User Question: {question}
-
-Requirements:
-1. Generate ONLY the SQL query, wrapped in ```sql``` code blocks
-2. Use proper JOINs to get descriptive names from lookup tables
+# Built once at import; only the question is spliced in per call.
+# Rules 2-6 are shared by the single-question and batch prompts.
+_REQUIREMENTS = """2. Use proper JOINs to get descriptive names from lookup tables
 3. Use appropriate aggregations (COUNT, AVG, SUM, etc.)
 4. Add LIMIT clauses for queries that might return many rows (default LIMIT 100)
 5. Use proper date/time functions for TIMESTAMP columns
 6. Add helpful column aliases using AS
+"""
 
-Generate the SQL query:"""
+_PROMPT_HEAD = "User Question: "
+_PROMPT_TAIL = (
+    "\nRequirements:\n"
+    "1. Generate ONLY the SQL query, wrapped in ```sql``` code blocks\n"
+    + _REQUIREMENTS
+    + "\nGenerate the SQL query:"
+)
+
+def _sql_request(question, model):
+    prompt = _PROMPT_HEAD + question + "\n" + _PROMPT_TAIL
+    return dict(
+        model=model,
+        messages=[
+            {"role": "system", "content": SYSTEM_PROMPT},
+            {"role": "user", "content": prompt}
+        ],
+        temperature=0.1,
+        max_tokens=completion_budget(prompt, model)
+    )
+
+# Shared with the concurrent path, which needs to look up hits before calling out
+@st.cache_resource
+def get_sql_cache():
+    return ResponseCache(max_entries=512, ttl=86400)
+
+def _sql_cache_key(question):
+    # The prompt hash is part of the key so schema edits invalidate old answers
+    return (question, SQL_MODEL, SYSTEM_PROMPT_HASH)
+
+def generate_sql_with_gpt(question):
+    cache = get_sql_cache()
+    key = _sql_cache_key(question)
+    sql_query = cache.get(key)
+    if sql_query is not None:
+        return sql_query
+    try:
+        client = get_openai_client()
+        response = client.chat.completions.create(**_sql_request(question, SQL_MODEL))
+        sql_query = extract_sql_from_response(response.choices[0].message.content)
+    except Exception as e:
+        st.error(f"Error calling OpenAI API: {e}")
+        return None
+    cache.set(key, sql_query)
+    return sql_query
+
+# ---------- Generate SQL for several questions concurrently ----------
+async def _gen_all(questions):
+    # A fresh client per event loop; httpx connections can't outlive asyncio.run
+    async with AsyncOpenAI(api_key=OPENAI_API_KEY) as client:
+        async def _gen(question):
+            response = await client.chat.completions.create(**_sql_request(question, SQL_MODEL))
+            return extract_sql_from_response(response.choices[0].message.content)
+        return await asyncio.gather(*[_gen(q) for q in questions], return_exceptions=True)
+
+def generate_sql_concurrent(questions):
+    """Return one SQL string (or None on failure) per question, with the calls in flight together."""
+    cache = get_sql_cache()
+    answers = {q: cache.get(_sql_cache_key(q)) for q in questions}
+    misses = [q for q, sql in answers.items() if sql is None]
+    if len(misses) == 1:
+        answers[misses[0]] = generate_sql_with_gpt(misses[0])
+    elif misses:
+        results = asyncio.run(_gen_all(misses))
+        for question, result in zip(misses, results):
+            if isinstance(result, Exception):
+                st.error(f"Error calling OpenAI API for '{question}': {result}")
+            else:
+                cache.set(_sql_cache_key(question), result)
+                answers[question] = result
+    return [answers[q] for q in questions]
+
+# ---------- Generate several SQL queries in one GPT call ----------
+BATCH_SIZE = 8
+
+_BATCH_HEAD = "User Questions:\n"
+_BATCH_TAIL = (
+    "\nRequirements:\n"
+    "1. Return ONLY a JSON array of SQL strings, one per question, in the same order\n"
+    + _REQUIREMENTS
+    + "\nGenerate the JSON array:"
+)
+
+def generate_sql_batch(questions):
+    """Return one SQL string per question, sharing a single schema prompt."""
+    cache = get_sql_cache()
+    answers = {q: cache.get(_sql_cache_key(q)) for q in questions}
+    # Only questions missing from the per-question cache go into the batch
+    misses = [q for q, sql in answers.items() if sql is None]
+    if len(misses) == 1:
+        answers[misses[0]] = generate_sql_with_gpt(misses[0])
+    elif misses:
+        answers.update(zip(misses, _generate_sql_batch(misses)))
+    return [answers[q] for q in questions]
+
+def _generate_sql_batch(questions):
+    client = get_openai_client()
+    numbered = "\n".join(f"Q{i}: {q}" for i, q in enumerate(questions, start=1))
+    prompt = _BATCH_HEAD + numbered + "\n" + _BATCH_TAIL
     try:
         response = client.chat.completions.create(
-            model="gpt-4o-mini",
+            model=SQL_MODEL,
             messages=[
-                {"role": "system", "content": "You are an SQLite expert."},
+                {"role": "system", "content": SYSTEM_PROMPT},
                 {"role": "user", "content": prompt}
             ],
             temperature=0.1,
-            max_tokens=1000
+            max_tokens=completion_budget(prompt, SQL_MODEL, cap=1000 * len(questions))
         )
         raw_text = response.choices[0].message.content
-        sql_query = extract_sql_from_response(raw_text)
-        return sql_query, response
+        sql_queries = json.loads(extract_sql_from_response(raw_text))
+        if isinstance(sql_queries, list) and len(sql_queries) == len(questions):
+            sql_queries = [str(q).strip() for q in sql_queries]
+            cache = get_sql_cache()
+            for question, sql in zip(questions, sql_queries):
+                cache.set(_sql_cache_key(question), sql)
+            return sql_queries
     except Exception as e:
-        st.error(f"Error calling OpenAI API: {e}")
-        return None, None
+        st.warning(f"Batch generation failed, falling back to one call per question: {e}")
+    # Fall back to concurrent per-question calls if the batch reply can't be used
+    return generate_sql_concurrent(questions)
+
+# ---------- SQL review panel ----------
+# Runs as a fragment so editing or running SQL doesn't rerun the whole page
+@st.fragment
+def sql_edit_panel():
+    if st.session_state.generated_sql:
+        st.markdown("---")
+        st.subheader("Generated SQL Query")
+        st.info(f"**Question:** {st.session_state.current_question}")
+
+        edited_sql = st.text_area(
+            "Review and edit the SQL query if needed:",
+            value=st.session_state.generated_sql,
+            height=400,
+            key="sql_editor"
+        )
+
+        col1, col2 = st.columns([1, 5])
+        with col1:
+            run_button = st.button("Run Query", type="primary", use_container_width=True)
+
+        if run_button and edited_sql.strip():
+            with st.spinner("Executing query ..."):
+                df = run_query(edited_sql)
+                if df is not None:
+                    st.session_state.query_history.append(
+                        {'question': st.session_state.current_question, 'sql': edited_sql, 'rows': len(df)}
+                    )
+                    st.markdown("---")
+                    st.subheader("📊 Query Results")
+                    st.success(f"✅ Query returned {len(df)} rows")
+                    if not df.empty:
+                        st.dataframe(df, use_container_width=True)
 
 # ---------- Streamlit app ----------
+HISTORY_SIZE = 50
+
+def _queue_question():
+    question = st.session_state.user_question.strip()
+    if question:
+        st.session_state.pending_questions.append(question)
+
 def main():
     st.title("🤖 AI-Powered SQL Query Assistant")
     st.markdown(
@@ -200,20 +298,34 @@ def main():
     if 'current_question' not in st.session_state:
         st.session_state.current_question = None
     if 'query_history' not in st.session_state:
-        st.session_state.query_history = [] 
+        st.session_state.query_history = deque(maxlen=HISTORY_SIZE)
+    if 'pending_questions' not in st.session_state:
+        st.session_state.pending_questions = []
+    if 'batch_results' not in st.session_state:
+        st.session_state.batch_results = []
 
     # User input
     user_question = st.text_area(
         "What would you like to know?",
         height=100,
-        placeholder="What is the average length of stay?"
+        placeholder="What is the average length of stay?",
+        key="user_question"
     )
 
-    col1, col2, col3 = st.columns([1, 1, 4])
+    col1, col2, col3, col4, _ = st.columns([1, 1, 1, 1, 2])
     with col1:
         generate_button = st.button("Generate SQL", type="primary", use_container_width=True)
     with col2:
         clear_button = st.button("Clear History", use_container_width=True)
+    with col3:
+        # Queue in a callback so the batch label below already shows the new count
+        st.button("Queue Question", on_click=_queue_question, use_container_width=True)
+    with col4:
+        batch_button = st.button(
+            f"Generate Batch ({len(st.session_state.pending_questions)})",
+            key="generate_batch",
+            use_container_width=True
+        )
 
     # Generate SQL
     if generate_button and user_question:
@@ -223,39 +335,37 @@ def main():
             st.session_state.current_question = None
 
         with st.spinner("🧠 AI is thinking and generating SQL..."):
-            sql_query, _ = generate_sql_with_gpt(user_question)
+            sql_query = generate_sql_with_gpt(user_question)
             if sql_query:
                 st.session_state.generated_sql = sql_query
                 st.session_state.current_question = user_question
 
-    # Display & edit SQL
-    if st.session_state.generated_sql:
+    # Generate queued questions together in one call
+    pending = st.session_state.pending_questions
+    if pending and (batch_button or len(pending) >= BATCH_SIZE):
+        with st.spinner(f"🧠 AI is generating SQL for {len(pending)} questions..."):
+            sql_queries = generate_sql_batch(pending)
+            st.session_state.batch_results = [
+                (q, sql) for q, sql in zip(pending, sql_queries) if sql
+            ]
+            st.session_state.pending_questions = []
+    elif pending:
+        st.caption(f"Queued questions: {len(pending)}/{BATCH_SIZE}")
+
+    if st.session_state.batch_results:
         st.markdown("---")
-        st.subheader("Generated SQL Query")
-        st.info(f"**Question:** {st.session_state.current_question}")
+        st.subheader("Batch Results")
+        for i, (question, sql) in enumerate(st.session_state.batch_results):
+            with st.expander(question):
+                st.code(sql, language="sql")
+                if st.button("Use this query", key=f"use_batch_{i}"):
+                    st.session_state.generated_sql = sql
+                    st.session_state.current_question = question
+                    # Reset the editor so it picks up the selected query
+                    st.session_state.pop("sql_editor", None)
 
-        edited_sql = st.text_area(
-            "Review and edit the SQL query if needed:",
-            value=st.session_state.generated_sql,
-            height=400,
-            key="sql_editor"
-        )
-
-        col1, col2 = st.columns([1, 5])
-        with col1:
-            run_button = st.button("Run Query", type="primary", use_container_width=True)
-
-        if run_button and edited_sql.strip():
-            with st.spinner("Executing query ..."):
-                df = run_query(edited_sql)
-                if df is not None:
-                    st.session_state.query_history.append(
-                        {'question': user_question, 'sql': edited_sql, 'rows': len(df)}
-                    )
-                    st.markdown("---")
-                    st.subheader("📊 Query Results")
-                    st.success(f"✅ Query returned {len(df)} rows")
-                    st.dataframe(df, use_container_width=True)
+    # Display & edit SQL
+    sql_edit_panel()
 
 if __name__ == "__main__":
     main()
@@ -0,0 +1,189 @@
+import re
+import time
+import hashlib
+import sqlite3
+import threading
+from collections import OrderedDict
+from functools import lru_cache
+
+import pandas as pd
+import tiktoken
+
+# ---------- SQLite connection setup ----------
+# Applied once on the cached connection so the page cache survives reruns.
+# All of these are per-connection, so the tracked patient.db is never rewritten.
+SQLITE_PRAGMAS = (
+    "PRAGMA synchronous=NORMAL;",
+    "PRAGMA temp_store=MEMORY;",
+    "PRAGMA mmap_size=268435456;",
+    "PRAGMA cache_size=-65536;",
+)
+
+def configure_sqlite(conn, extra_statements=()):
+    """Apply SQLITE_PRAGMAS and extra_statements, skipping any the database refuses."""
+    for statement in (*SQLITE_PRAGMAS, *extra_statements):
+        try:
+            conn.execute(statement)
+        except sqlite3.OperationalError:
+            # e.g. CREATE INDEX on a read-only database; carry on without it
+            pass
+
+# ---------- Chunked query reads ----------
+CHUNK_SIZE = 10_000
+MAX_ROWS = 200_000
+
+def read_sql_chunked(sql, conn, params=None):
+    """Read a query in chunks, stopping at MAX_ROWS; return (df, truncated)."""
+    reader = pd.read_sql_query(sql, conn, params=params, chunksize=CHUNK_SIZE)
+    chunks = []
+    total = 0
+    truncated = False
+    for chunk in reader:
+        chunks.append(chunk)
+        total += len(chunk)
+        if total >= MAX_ROWS:
+            # Only report truncation if rows were actually left behind
+            truncated = total > MAX_ROWS or next(reader, None) is not None
+            break
+    if not chunks:
+        return pd.DataFrame(), False
+    df = pd.concat(chunks, ignore_index=True).iloc[:MAX_ROWS]
+    return df, truncated
+
+# ---------- Database schema ----------
+DATABASE_SCHEMA = """
+Database Schema:
+
+LOOKUP TABLES:
+- genders (gender_id INTEGER PRIMARY KEY, gender_desc TEXT)
+- races (race_id INTEGER PRIMARY KEY, race_desc TEXT)
+- marital_statuses (marital_status_id INTEGER PRIMARY KEY, marital_status_desc TEXT)
+- languages (language_id INTEGER PRIMARY KEY, language_desc TEXT)
+- lab_units (unit_id INTEGER PRIMARY KEY, unit_string TEXT)
+- lab_tests (lab_test_id INTEGER PRIMARY KEY, lab_name TEXT, unit_id INTEGER)
+- diagnosis_codes (diagnosis_code TEXT PRIMARY KEY, diagnosis_description TEXT)
+
+CORE TABLES:
+- patients (
+    patient_id TEXT PRIMARY KEY,
+    patient_gender INTEGER REFERENCES genders(gender_id),
+    patient_dob TIMESTAMP,
+    patient_race INTEGER REFERENCES races(race_id),
+    patient_marital_status INTEGER REFERENCES marital_statuses(marital_status_id),
+    patient_language INTEGER REFERENCES languages(language_id),
+    patient_population_pct_below_poverty REAL
+)
+
+- admissions (
+    patient_id TEXT,
+    admission_id INTEGER,
+    admission_start TIMESTAMP,
+    admission_end TIMESTAMP,
+    PRIMARY KEY (patient_id, admission_id)
+)
+
+- admission_primary_diagnoses (
+    patient_id TEXT,
+    admission_id INTEGER,
+    diagnosis_code TEXT REFERENCES diagnosis_codes(diagnosis_code),
+    PRIMARY KEY (patient_id, admission_id)
+)
+
+- admission_lab_results (
+    patient_id TEXT,
+    admission_id INTEGER,
+    lab_value REAL,
+    lab_datetime TIMESTAMP,
+    lab_test_id INTEGER REFERENCES lab_tests(lab_test_id)
+)
+"""
+
+# Kept byte-for-byte identical across requests so OpenAI's prompt cache hits
+SYSTEM_PROMPT = DATABASE_SCHEMA + "\nYou are an SQLite expert."
+
+# Part of every response cache key so prompt edits invalidate old answers
+SYSTEM_PROMPT_HASH = hashlib.md5(SYSTEM_PROMPT.encode()).hexdigest()
+
+# ---------- Response cache ----------
+class ResponseCache:
+    """Thread-safe LRU cache with a per-entry TTL, shared across Streamlit sessions."""
+
+    def __init__(self, max_entries=512, ttl=86400):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            stored_at, value = entry
+            if time.monotonic() - stored_at > self.ttl:
+                del self._entries[key]
+                return None
+            self._entries.move_to_end(key)
+            return value
+
+    def set(self, key, value):
+        with self._lock:
+            self._entries[key] = (time.monotonic(), value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+# ---------- Token budgeting ----------
+CONTEXT_WINDOWS = {
+    "gpt-4o-mini": 128_000,
+    "gpt-4": 8_192,
+}
+RESPONSE_MARGIN = 64
+
+@lru_cache(maxsize=None)
+def _get_encoding(model):
+    # tiktoken downloads the BPE file on first use; None means "count unavailable"
+    try:
+        return tiktoken.encoding_for_model(model)
+    except Exception:
+        return None
+
+@lru_cache(maxsize=None)
+def _system_prompt_tokens(model):
+    return len(_get_encoding(model).encode(SYSTEM_PROMPT))
+
+def completion_budget(user_prompt, model, cap=1000):
+    """Return max_tokens for a request, leaving room for the prompt in the context window."""
+    encoding = _get_encoding(model)
+    if encoding is None or model not in CONTEXT_WINDOWS:
+        return cap
+    prompt_tokens = _system_prompt_tokens(model) + len(encoding.encode(user_prompt))
+    remaining = CONTEXT_WINDOWS[model] - prompt_tokens - RESPONSE_MARGIN
+    return max(1, min(cap, remaining))
+
+# ---------- Extract SQL from GPT response ----------
+_SQL_RE = re.compile(r"```sql\s*(.*?)\s*```", re.DOTALL | re.IGNORECASE)
+_CODE_RE = re.compile(r"```(?:\w+)?\s*(.*?)\s*```", re.DOTALL)
+
+def extract_sql_from_response(response_text):
+    match = _SQL_RE.search(response_text) or _CODE_RE.search(response_text)
+    if match:
+        return match.group(1).strip()
+    return response_text.strip()
+
+# ---------- Read-only guard ----------
+# A cheap pre-check only. The real guarantee is PRAGMA query_only=ON on the
+# query connections, which this check also keeps from being switched off.
+_LEADING_COMMENTS_RE = re.compile(r"(?:\s+|--[^\n]*|/\*.*?\*/)*", re.DOTALL)
+_READ_QUERY_RE = re.compile(r"\(*\s*(WITH|SELECT)\b", re.IGNORECASE)
+# Introspection PRAGMAs only; no assignments such as query_only=OFF
+_READ_PRAGMA_RE = re.compile(
+    r"PRAGMA\s+(?:\w+\.)?(table_info|table_xinfo|table_list|index_list|index_info"
+    r"|index_xinfo|foreign_key_list|database_list)\s*(?:\(\s*[\w\"'`]+\s*\))?\s*;?\s*$",
+    re.IGNORECASE,
+)
+
+def is_read_query(sql):
+    """Return True if the SQL, after leading comments, looks like a read query."""
+    sql = sql[_LEADING_COMMENTS_RE.match(sql).end():]
+    return bool(_READ_QUERY_RE.match(sql) or _READ_PRAGMA_RE.match(sql))